@@ -21,14 +21,14 @@ python ./csv2osm.py MLI_schools.csv
 ls -lh changesets
 
 echo "Convert all OSM XML files into OSM Changeset files"
-find changesets -name '*.osm' -exec python ./osm2change-python2.py {} \;
+find changesets -name '*.osm' -exec python3 ./osm2change.py {} +
 
 ls -lh changesets
 
 if [ "x$OSM_UPLOAD" = "xy" ];
 	then
 	echo "Uploading Changeset files"
-	find changesets -name '*.osc' -exec echo ./upload-python2.py -u opendatamali -p $OSM_PASSWD -m "Schools for {}" -c y $LIVE {} \;
+	find changesets -name '*.osc' -exec echo python3 ./upload.py -u opendatamali -p $OSM_PASSWD -m "Schools for {}" -c y $LIVE {} \;
 else
 	echo "Skipping upload. Use OSM_UPLOAD=y to Upload."
 	echo "Use OSM_LIVE=y to target Live OSM server (defaults to dev)."
@@ -9,10 +9,29 @@ from __future__ import (unicode_literals, absolute_import,
 import sys
 import os
 import re
+import io
+import json
+import heapq
+import argparse
+import itertools
 import datetime
+import tempfile
+import multiprocessing
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 import unicodecsv as csv
 
+headers = ['Région', 'AE', 'CAP', 'Cercle', 'Commune',
+           'NOM_ETABLISSEMENT', 'Localites', 'X', 'Y',
+           'CODE_ETABLISSEMENT', 'Localisation', 'CYCLE',
+           'STATUT', 'PRESENCE_RESTAURANT', 'PRESENCE_LATRINES',
+           'LATRINES_FILLES_SEPAREES', 'NOMBRE_LATRINES',
+           'EAU_POTABLE', 'GARCONS', 'FILLES', 'TOTAL',
+           'NBRE ENSEIGNANTS']
+
 xml_head = ('<?xml version="1.0" encoding="UTF-8"?>\n'
             '<osm version="0.6" generator="csv2osm.py">\n'
             '<bounds minlat="{minlat}" minlon="{minlon}" '
@@ -26,6 +45,37 @@ node_tmpl = '<node id="{id}" version="1" changeset="{id}" ' \
             '{tags}\n' \
             '</node>'
 
+# every key getNodeTags() may emit, in a stable order for columnar formats
+tag_keys = ['amenity', 'name', 'operator:type', 'source',
+            'school:ML:academie', 'school:ML:cap', 'isced:level',
+            'capacity:pupils', 'capacity:teachers',
+            'drinking_water', 'drinking_water:type',
+            'drinking_water:seasonal', 'restaurant',
+            'toilets', 'toilets:number',
+            'is_in:cercle', 'is_in:commune', 'is_in:village', 'addr:city']
+integer_tag_keys = ['capacity:pupils', 'capacity:teachers', 'toilets:number']
+
+statuses = {
+    "Communautaire": "community",
+    "Medersa": "religious",
+    "Privé confessionnel": "religious",
+    "Privé laïc": "private",
+    "Public": "public"
+}
+
+water_options = {
+    "1) robinet ": "tap",
+    "2) forage fonctionnel": "working_drilling",
+    "3) puits non tarrissable": "inexhaustible_well",
+    "4) puits tarrissable": "exhaustible_well",
+    "5) pas de point d'eau": "no_water_point",
+    "indeterminé": "unknown",
+    "": "unknown"
+}
+
+drinkable_water_points = ['tap', 'working_drilling',
+                          'inexhaustible_well', 'exhaustible_well']
+
 
 def getTag(key, value):
     return '<tag k="{key}" v="{value}"/>'.format(key=key, value=value)
@@ -244,134 +294,529 @@ def cleanName(s):
     return s
 
 
-def getNode(entry, lnum):
-
-    # Schools are `1er cycle` or `2ème cycle`
-    cycle = 1 if entry.get('CYCLE') == "1er cycle" else 2
-    has_latrines = entry.get('PRESENCE_LATRINES') == '1'
-    # has_girl_latrines = entry.get('LATRINES_FILLES_SEPAREES') == '1'
-    nb_latrines = int(entry.get('NOMBRE_LATRINES')) \
-        if entry.get('NOMBRE_LATRINES') else 0
-    nb_teachers = int(entry.get('NBRE ENSEIGNANTS')) \
-        if entry.get('NBRE ENSEIGNANTS') else None
-
-    statuses = {
-        "Communautaire": "community",
-        "Medersa": "religious",
-        "Privé confessionnel": "religious",
-        "Privé laïc": "private",
-        "Public": "public"
-    }
-
-    water_options = {
-        "1) robinet ": "tap",
-        "2) forage fonctionnel": "working_drilling",
-        "3) puits non tarrissable": "inexhaustible_well",
-        "4) puits tarrissable": "exhaustible_well",
-        "5) pas de point d'eau": "no_water_point",
-        "indeterminé": "unknown",
-        "": "unknown"
-    }
-
-    water_point = water_options.get(entry.get('EAU_POTABLE'))
-    has_drinkable_water = water_point in [
-        'tap', 'working_drilling', 'inexhaustible_well', 'exhaustible_well']
-
-    # status are `Communautaire` or `Medersa` or `Privé confessionnel`
-    # or `Privé laïc` or `Public`
+class School(object):
+    """ One school, parsed once from its CSV row
+
+        Repeated labels are interned and cycle, status and water point are
+        kept as shared codes, so only the name is owned by each record.
+        The constructor takes values as parseRecord() returns them, already
+        interned; unpickling interns again, so records from a saved index
+        or a sort run share their labels. """
+
+    __slots__ = ['lnum', 'code', 'name', 'academy', 'cap', 'cercle',
+                 'commune', 'village', 'lon', 'lat', 'cycle', 'status',
+                 'water', 'restaurant', 'latrines', 'nb_latrines',
+                 'boys', 'girls', 'pupils', 'nb_teachers']
+
+    interned_slots = ['academy', 'cap', 'cercle', 'commune', 'village',
+                      'status', 'water']
+
+    def __init__(self, lnum, code, name, academy, cap, cercle, commune,
+                 village, lon, lat, cycle, status, water, restaurant,
+                 latrines, nb_latrines, boys, girls, pupils, nb_teachers):
+        # plain assignments: this runs once per school in the parent
+        # process whatever the number of parsing workers
+        self.lnum = lnum
+        self.code = code
+        self.name = name
+        self.academy = academy
+        self.cap = cap
+        self.cercle = cercle
+        self.commune = commune
+        self.village = village
+        self.lon = lon
+        self.lat = lat
+        self.cycle = cycle
+        self.status = status
+        self.water = water
+        self.restaurant = restaurant
+        self.latrines = latrines
+        self.nb_latrines = nb_latrines
+        self.boys = boys
+        self.girls = girls
+        self.pupils = pupils
+        self.nb_teachers = nb_teachers
+
+    def __getstate__(self):
+        return tuple([getattr(self, slot) for slot in self.__slots__])
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+        for slot in self.interned_slots:
+            setattr(self, slot, internValue(getattr(self, slot)))
+
+    @property
+    def id(self):
+        return -self.lnum
+
+
+interned = {}
+
+
+def internValue(value):
+    return interned.setdefault(value, value)
+
+
+def toInt(value, default=0):
+    return int(value) if value else default
+
+
+def parseSchool(row, lnum, unlocated=False):
+    """ School from a raw CSV row, None when it has no coordinates
+
+        With unlocated, such rows give a School whose lon and lat are
+        None instead. """
+    record = parseRecord(row, lnum, unlocated)
+    return School(*record) if record is not None else None
+
+
+def parseRecord(row, lnum, unlocated=False):
+    """ School constructor arguments for a raw CSV row, see parseSchool """
+    if not row:
+        return None
+
+    (region, academy, cap, cercle, commune, name, village, lon, lat,
+     code, location, cycle, status, restaurant, latrines, girls_latrines,
+     nb_latrines, water, boys, girls, pupils, nb_teachers) = row
+
+    # don't export data without coordinates
+    if not lon or not lat:
+        if not unlocated:
+            return None
+        lon = lat = None
+    else:
+        lon, lat = float(lon), float(lat)
+
+    return (
+        lnum, code, cleanName(name), internValue(academy), internValue(cap),
+        internValue(clean(cercle)), internValue(clean(commune)),
+        internValue(clean(village)),
+        lon, lat,
+        # Schools are `1er cycle` or `2ème cycle`
+        1 if cycle == "1er cycle" else 2,
+        # status are `Communautaire` or `Medersa` or `Privé confessionnel`
+        # or `Privé laïc` or `Public`
+        internValue(status),
+        internValue(water_options.get(water)),
+        restaurant == '1',
+        latrines == '1',
+        toInt(nb_latrines),
+        toInt(boys), toInt(girls), toInt(pupils),
+        toInt(nb_teachers, None))
+
+
+def getNodeTags(school):
+
+    has_drinkable_water = school.water in drinkable_water_points
 
     tags = {
         'amenity': 'school',
-        'name': cleanName(entry.get('NOM_ETABLISSEMENT')),
-        'operator:type': statuses.get(entry.get('STATUT')),
+        'name': school.name,
+        'operator:type': statuses.get(school.status),
         'source': "UNICEF",
 
         # school classification
-        'school:ML:academie': entry.get('AE'),
-        'school:ML:cap': entry.get('CAP'),
+        'school:ML:academie': school.academy,
+        'school:ML:cap': school.cap,
 
-        'isced:level': 1 if cycle == 1 else '2,3',
+        'isced:level': 1 if school.cycle == 1 else '2,3',
 
-        # 'school:first_cycle': yesno(cycle == 1),
-        # 'school:second_cycle': yesno(cycle == 2),
+        # 'school:first_cycle': yesno(school.cycle == 1),
+        # 'school:second_cycle': yesno(school.cycle == 2),
 
         # Students
-        # 'school:nb_schoolboys_2012': int(entry.get('GARCONS')),
-        # 'school:nb_schoolgirls_2012': int(entry.get('FILLES')),
-        'capacity:pupils': int(entry.get('TOTAL')),
+        # 'school:nb_schoolboys_2012': school.boys,
+        # 'school:nb_schoolgirls_2012': school.girls,
+        'capacity:pupils': school.pupils,
 
         'drinking_water': yesno(has_drinkable_water),
 
-        'restaurant':
-            yesno(entry.get('PRESENCE_RESTAURANT') == '1'),
-        'toilets': yesno(has_latrines),
-        'toilets:number': nb_latrines,
+        'restaurant': yesno(school.restaurant),
+        'toilets': yesno(school.latrines),
+        'toilets:number': school.nb_latrines,
     }
     # admin levels of Mali
-    # if entry.get('Région'):
-    #     tags.update({'is_in:region': clean(entry.get('Région'))})
-    if entry.get('Cercle'):
-        tags.update({'is_in:cercle': clean(entry.get('Cercle'))})
-    if entry.get('Commune'):
-        tags.update({'is_in:commune': clean(entry.get('Commune'))})
-    if entry.get('Localites'):
-        tags.update({'is_in:village': clean(entry.get('Localites')),
-                     'addr:city': clean(entry.get('Localites'))})
+    if school.cercle:
+        tags.update({'is_in:cercle': school.cercle})
+    if school.commune:
+        tags.update({'is_in:commune': school.commune})
+    if school.village:
+        tags.update({'is_in:village': school.village,
+                     'addr:city': school.village})
 
     # School code
-    # if entry.get('CODE_ETABLISSEMENT'):
-    #     tags.update({'school:ML:code': entry.get('CODE_ETABLISSEMENT')})
-
-    # if has_latrines:
-    #     tags.update({'school:has_separated_girls_latrines':
-    #                  yesno(has_girl_latrines)})
+    # if school.code:
+    #     tags.update({'school:ML:code': school.code})
 
     if has_drinkable_water:
-        tags.update({'drinking_water:type': water_point})
+        tags.update({'drinking_water:type': school.water})
         tags.update({'drinking_water:seasonal':
-                     yesno(water_point == 'exhaustible_well')})
+                     yesno(school.water == 'exhaustible_well')})
+
+    if school.nb_teachers is not None:
+        tags.update({'capacity:teachers': school.nb_teachers})
 
-    if nb_teachers is not None:
-        tags.update({'capacity:teachers': nb_teachers})
+    return tags
+
+
+def getNode(school, tags=None):
+    if tags is None:
+        tags = getNodeTags(school)
 
     data = {
         'tags': getTags(**tags),
-        'id': -lnum,
-        'changeset': -lnum,
-        'lat': entry.get('Y'),
-        'lon': entry.get('X'),
+        'id': school.id,
+        'changeset': school.id,
+        'lat': repr(school.lat),
+        'lon': repr(school.lon),
         'timestamp': getTimestamp()
     }
     return node_tmpl.format(**data)
 
 
-def getBounds(nodes):
-    minlat = minlon = maxlat = maxlon = None
-    for node, node_latlon in nodes:
-        lat, lon = node_latlon
-        if lat > maxlat or maxlat is None:
-            maxlat = lat
-        if lat < minlat or minlat is None:
-            minlat = lat
-        if lon > maxlon or maxlon is None:
-            maxlon = lon
-        if lon < minlon or minlon is None:
-            minlon = lon
-
-    return minlat, minlon, maxlat, maxlon
-
-
-def main(filename):
-    headers = ['Région', 'AE', 'CAP', 'Cercle', 'Commune',
-               'NOM_ETABLISSEMENT', 'Localites', 'X', 'Y',
-               'CODE_ETABLISSEMENT', 'Localisation', 'CYCLE',
-               'STATUT', 'PRESENCE_RESTAURANT', 'PRESENCE_LATRINES',
-               'LATRINES_FILLES_SEPAREES', 'NOMBRE_LATRINES',
-               'EAU_POTABLE', 'GARCONS', 'FILLES', 'TOTAL',
-               'NBRE ENSEIGNANTS']
+def getFeature(school, tags=None):
+    if tags is None:
+        tags = getNodeTags(school)
+
+    return {
+        'type': 'Feature',
+        'id': school.id,
+        'geometry': {
+            'type': 'Point',
+            'coordinates': [school.lon, school.lat]
+        },
+        'properties': tags
+    }
+
+
+class GeoJSONSeqWriter(object):
+    """ Newline-delimited GeoJSON, one Feature per line """
+
+    def __init__(self, path):
+        self.output_file = open(path, 'wb')
+
+    def write(self, feature):
+        line = json.dumps(feature, ensure_ascii=False,
+                          separators=(',', ':'))
+        self.output_file.write(line.encode('utf-8'))
+        self.output_file.write(b'\n')
+
+    def close(self):
+        self.output_file.close()
+
+
+class FlatGeobufWriter(object):
+    """ FlatGeobuf layer (through OGR) with a packed Hilbert R-tree
+
+        OGR spools features to disk and builds the index on close so
+        memory use does not grow with the number of schools. """
+
+    def __init__(self, path):
+        # GDAL is only loaded when a FlatGeobuf is asked for
+        try:
+            from osgeo import ogr, osr
+        except ImportError:
+            raise RuntimeError("FlatGeobuf export requires GDAL/OGR "
+                               "Python bindings (osgeo)")
+        self.ogr = ogr
+        driver = ogr.GetDriverByName(str('FlatGeobuf'))
+        if driver is None:
+            raise RuntimeError("GDAL build lacks the FlatGeobuf driver")
+        if os.path.exists(path):
+            driver.DeleteDataSource(path)
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        self.datasource = driver.CreateDataSource(path)
+        self.layer = self.datasource.CreateLayer(
+            str('schools'), srs, ogr.wkbPoint, [str('SPATIAL_INDEX=YES')])
+        for key in tag_keys:
+            field_type = ogr.OFTInteger if key in integer_tag_keys \
+                else ogr.OFTString
+            self.layer.CreateField(ogr.FieldDefn(str(key), field_type))
+        self.layer_defn = self.layer.GetLayerDefn()
+
+    def write(self, feature):
+        ogr = self.ogr
+        ogr_feature = ogr.Feature(self.layer_defn)
+        ogr_feature.SetFID(feature['id'])
+        for key, value in feature['properties'].items():
+            ogr_feature.SetField(str(key), value)
+        lon, lat = feature['geometry']['coordinates']
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint_2D(lon, lat)
+        ogr_feature.SetGeometry(point)
+        self.layer.CreateFeature(ogr_feature)
+
+    def close(self):
+        self.layer = self.layer_defn = None
+        self.datasource = None
+
+
+def extendBounds(bounds, school):
+    """ (minlat, minlon, maxlat, maxlon) grown to include the school """
+    if bounds is None:
+        return school.lat, school.lon, school.lat, school.lon
+    minlat, minlon, maxlat, maxlon = bounds
+    return (min(minlat, school.lat), min(minlon, school.lon),
+            max(maxlat, school.lat), max(maxlon, school.lon))
+
+
+def getAcademyName(school):
+    return clean(school.academy).replace(' ', '-')
+
+
+def hilbertKey(school, order=16):
+    """ distance along a Hilbert curve laid over the whole globe """
+    side = 1 << order
+    x = int((school.lon + 180.0) / 360.0 * (side - 1))
+    y = int((school.lat + 90.0) / 180.0 * (side - 1))
+    distance = 0
+    step = side >> 1
+    while step:
+        rx = 1 if x & step else 0
+        ry = 1 if y & step else 0
+        distance += step * step * ((3 * rx) ^ ry)
+        # rotate the quadrant so the curve stays continuous
+        if not ry:
+            if rx:
+                x = side - 1 - x
+                y = side - 1 - y
+            x, y = y, x
+        step >>= 1
+    return distance
+
+
+geohash_alphabet = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohashKey(school, precision=12):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = nb_bits = 0
+    even = True
+    while len(geohash) < precision:
+        if even:
+            value_range, value = lon_range, school.lon
+        else:
+            value_range, value = lat_range, school.lat
+        middle = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        even = not even
+        nb_bits += 1
+        if nb_bits == 5:
+            geohash.append(geohash_alphabet[bits])
+            bits = nb_bits = 0
+    return ''.join(geohash)
+
+
+# order of the nodes inside each academy file
+node_orders = {
+    'csv': None,
+    'hilbert': hilbertKey,
+    'geohash': geohashKey,
+}
+
+
+def readSchools(filename, processes=1, unlocated=False):
+    """ yields a School for each row with coordinates, in file order
+
+        With several processes the file is split on record boundaries
+        and the chunks are parsed in parallel; workers send back plain
+        tuples, which unpickle without any Python-level code, and the
+        Schools are only built here. With unlocated, rows without
+        coordinates are yielded too (see parseSchool). """
+    if processes > 1:
+        chunks = [chunk + (unlocated,)
+                  for chunk in splitRecords(filename, processes * 4)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            for records in pool.imap(parseChunk, chunks):
+                for school in itertools.starmap(School, records):
+                    yield school
+        finally:
+            pool.terminate()
+        return
+
+    with open(filename, 'r') as input_csv_file:
+        csv_reader = csv.reader(input_csv_file)
+        for row in csv_reader:
+            if csv_reader.line_num == 1:
+                continue
+
+            school = parseSchool(row, csv_reader.line_num, unlocated)
+            if school is not None:
+                yield school
+
+
+def splitRecords(filename, nb_chunks, block_size=1 << 20):
+    """ [(filename, start, end, lines before start)] covering the file
+
+        Chunks end right after a newline outside of any quoted field.
+        Quote parity and newlines are counted over the whole file, which
+        is much cheaper than parsing it, so embedded newlines neither
+        split a record nor shift the line numbers used as node ids. """
+    size = os.path.getsize(filename)
+    targets = [size * index // nb_chunks for index in range(1, nb_chunks)]
+    chunks = []
+    start = 0
+    start_lines = 0
+    offset = 0
+    lines = 0
+    quotes = 0
+    with open(filename, 'rb') as input_csv_file:
+        while targets:
+            block = input_csv_file.read(block_size)
+            if not block:
+                break
+            pos = 0
+            while targets and offset + len(block) > targets[0]:
+                target = max(targets[0] - offset, pos)
+                newline = block.find(b'\n', target)
+                if newline < 0:
+                    break
+                lines += block.count(b'\n', pos, newline + 1)
+                quotes += block.count(b'"', pos, newline + 1)
+                pos = newline + 1
+                if quotes % 2:
+                    # inside a quoted field: try the following newline
+                    targets[0] = offset + pos
+                    continue
+                if offset + pos > start:
+                    chunks.append((filename, start, offset + pos,
+                                   start_lines))
+                    start, start_lines = offset + pos, lines
+                targets.pop(0)
+                # skip targets already passed by this boundary
+                while targets and targets[0] < start:
+                    targets.pop(0)
+            lines += block.count(b'\n', pos)
+            quotes += block.count(b'"', pos)
+            offset += len(block)
+    if start < size:
+        chunks.append((filename, start, size, start_lines))
+    return chunks
+
+
+def parseChunk(chunk):
+    """ parseRecord() tuples of one readSchools() chunk
+
+        Line numbers are file-wide. Labels interned in the worker stay
+        shared through the pickle memo once the list is sent back. """
+    filename, start, end, start_lines, unlocated = chunk
+    with open(filename, 'rb') as input_csv_file:
+        input_csv_file.seek(start)
+        data = input_csv_file.read(end - start)
+
+    records = []
+    csv_reader = csv.reader(io.BytesIO(data))
+    for row in csv_reader:
+        lnum = start_lines + csv_reader.line_num
+        if lnum == 1:
+            continue
+
+        record = parseRecord(row, lnum, unlocated)
+        if record is not None:
+            records.append(record)
+    return records
+
+
+def externalSort(items, key, buffer_size=200000):
+    """ yields items ordered by key(item), stable
+
+        Up to buffer_size items are sorted in memory; longer inputs are
+        spilled as sorted runs to temporary files and merged back. """
+    runs = []
+    buffer = []
+    for seq, item in enumerate(items):
+        buffer.append((key(item), seq, item))
+        if len(buffer) >= buffer_size:
+            runs.append(spillRun(buffer))
+            buffer = []
+    buffer.sort()
+
+    if not runs:
+        for decorated in buffer:
+            yield decorated[2]
+        return
+
+    if buffer:
+        runs.append(spillRun(buffer))
+    try:
+        for decorated in heapq.merge(*[readRun(run) for run in runs]):
+            yield decorated[2]
+    finally:
+        for run in runs:
+            run.close()
+
+
+def spillRun(buffer):
+    buffer.sort()
+    run = tempfile.TemporaryFile()
+    pickler = pickle.Pickler(run, pickle.HIGHEST_PROTOCOL)
+    for decorated in buffer:
+        pickler.dump(decorated)
+        # don't let the memo keep every spilled item alive
+        pickler.clear_memo()
+    run.seek(0)
+    return run
+
+
+def readRun(run):
+    unpickler = pickle.Unpickler(run)
+    while True:
+        try:
+            yield unpickler.load()
+        except EOFError:
+            return
+
+
+def getCodesPath(filename):
+    """ `.codes` file next to an .osm/.osc file or its base name """
+    for extension in ('.osm', '.osc'):
+        if filename.endswith(extension):
+            filename = filename[:-len(extension)]
+    return filename + '.codes'
+
+
+class CodesWriter(object):
+    """ CODE_ETABLISSEMENT of each element id written to an OSM file
+
+        Upload results only know element ids; this is what lets them be
+        tied back to schools (see registrydiff.applyResults). """
+
+    def __init__(self, filename):
+        self.codes_file = open(getCodesPath(filename), 'wb')
+        self.csv_writer = csv.writer(self.codes_file, encoding='utf-8')
+        self.csv_writer.writerow(['id', 'CODE_ETABLISSEMENT'])
+
+    def write(self, element_id, code):
+        # uncoded schools can't be followed from one release to the next
+        if code:
+            self.csv_writer.writerow([element_id, code])
+
+    def close(self):
+        self.codes_file.close()
+
+
+def readCodes(filename):
+    """ {element id: code} from the `.codes` file of an OSM file """
+    with open(getCodesPath(filename), 'rb') as codes_file:
+        csv_reader = csv.reader(codes_file, encoding='utf-8')
+        next(csv_reader)
+        return dict((int(element_id), code)
+                    for element_id, code in csv_reader)
+
+
+def main(filename, geojsonseq=None, flatgeobuf=None, processes=1,
+         order='csv', sort_buffer=200000):
     folder = 'changesets'
-    input_csv_file = open(filename, 'r')
-    csv_reader = csv.DictReader(input_csv_file, fieldnames=headers)
 
     # create changeset folder if exist
     try:
@@ -379,48 +824,98 @@ def main(filename):
     except:
         pass
 
-    def write_file(academy, nodes):
-        print("Writting ACADEMIE {}/{}".format(academy, len(nodes)))
-        minlat, minlon, maxlat, maxlon = getBounds(nodes)
+    def write_file(academy, schools):
+        nb_schools, bounds = academies[academy]
+        print("Writting ACADEMIE {}/{}".format(academy, nb_schools))
+        minlat, minlon, maxlat, maxlon = bounds
         output_osm_file = open(os.path.join(folder,
                                             '{}.osm'.format(academy)), 'w')
         output_osm_file.write(xml_head.format(
             minlat=minlat, minlon=minlon, maxlat=maxlat, maxlon=maxlon))
-        for node, node_latlon in nodes:
-            output_osm_file.write(node.encode('utf-8'))
+        codes = CodesWriter(os.path.join(folder, academy))
+        for school in schools:
+            output_osm_file.write(getNode(school).encode('utf-8'))
             output_osm_file.write('\n')
+            codes.write(school.id, school.code)
         output_osm_file.write(xml_tail)
         output_osm_file.close()
+        codes.close()
 
+    # GeoJSON outputs are streamed row by row, not kept per academy
+    feature_writers = []
+    if geojsonseq:
+        feature_writers.append(GeoJSONSeqWriter(geojsonseq))
+    if flatgeobuf:
+        feature_writers.append(FlatGeobufWriter(flatgeobuf))
+
+    # academy: [number of schools, bounds]
     academies = {}
 
-    for entry in csv_reader:
-        if csv_reader.line_num == 1:
-            continue
+    def read_schools():
+        for school in readSchools(filename, processes):
+            ac = getAcademyName(school)
+            if ac not in academies.keys():
+                academies[ac] = [0, None]
+            academies[ac][0] += 1
+            academies[ac][1] = extendBounds(academies[ac][1], school)
 
-        # don't export data without coordinates
-        if not entry.get('X') or not entry.get('Y'):
-            continue
+            # one line per school would be serial work again with -j
+            if processes == 1:
+                print(school.name)
 
-        ac = clean(entry.get('AE')).replace(' ', '-')
-        if ac not in academies.keys():
-            academies[ac] = []
+            if feature_writers:
+                feature = getFeature(school)
+                for writer in feature_writers:
+                    writer.write(feature)
 
-        print(cleanName(entry.get('NOM_ETABLISSEMENT')))
+            yield school
 
-        school_node = getNode(entry, csv_reader.line_num)
-        school_latlon = (float(entry.get('Y')), float(entry.get('X')))
-        academies[ac].append((school_node, school_latlon))
+    # schools are grouped by academy, then ordered along node_key;
+    # ids stay -line so any order gives the same nodes
+    node_key = node_orders[order]
 
-    input_csv_file.close()
+    def sort_key(school):
+        return (getAcademyName(school),
+                node_key(school) if node_key else 0, school.lnum)
 
-    for ac, nodes in academies.items():
-        write_file(ac, nodes)
+    schools = externalSort(read_schools(), sort_key, sort_buffer)
+    for ac, academy_schools in itertools.groupby(schools, getAcademyName):
+        write_file(ac, academy_schools)
+
+    for writer in feature_writers:
+        writer.close()
 
     print("Export complete.")
 
+# `csv2osm.py <subcommand> ...` runs that module's main() instead
+subcommands = {
+    'stats': ('schoolstats', 'main'),
+    'diff': ('registrydiff', 'main'),
+    'apply-results': ('registrydiff', 'applyMain'),
+}
+
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print("You must pass the MLI_schools.csv path")
-        sys.exit(1)
-    main(sys.argv[1])
+    if len(sys.argv) > 1 and sys.argv[1] in subcommands:
+        module, function = subcommands[sys.argv[1]]
+        getattr(__import__(module), function)(sys.argv[2:])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('filename', help="MLI_schools.csv path")
+    parser.add_argument('--geojsonseq', metavar='PATH',
+                        help="also write newline-delimited GeoJSON")
+    parser.add_argument('--flatgeobuf', metavar='PATH',
+                        help="also write an indexed FlatGeobuf (needs GDAL)")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="processes parsing the CSV, 0 for one per CPU")
+    parser.add_argument('--order', choices=sorted(node_orders.keys()),
+                        default='csv',
+                        help="order of the nodes in each academy file")
+    parser.add_argument('--sort-buffer', type=int, default=200000,
+                        help="schools sorted in memory before spilling "
+                             "to disk (default: 200000)")
+    args = parser.parse_args()
+    main(args.filename, geojsonseq=args.geojsonseq,
+         flatgeobuf=args.flatgeobuf,
+         processes=args.jobs or multiprocessing.cpu_count(),
+         order=args.order, sort_buffer=args.sort_buffer)
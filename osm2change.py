@@ -0,0 +1,102 @@
+#! /usr/bin/env python3
+# vim: fileencoding=utf-8 encoding=utf-8 et sw=4
+
+# Copyright (C) 2009 Jacek Konieczny <jajcus@jajcus.net>
+# Copyright (C) 2009 Andrzej Zaborowski <balrogg@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""
+Convert .osm files to osmChange 0.3 format.
+
+Python 3 port of osm2change-python2.py.  Accepts several files so a
+single process can convert every academy.
+"""
+
+__version__ = "$Revision: 21 $"
+
+import os
+import sys
+
+
+def osmsort(tree, order):
+    tree[0:len(tree)] = sorted(tree, key=lambda x: order.index(x.tag))
+
+
+def convert(filename):
+    import xml.etree.ElementTree as ElementTree
+
+    if filename.endswith(".osm"):
+        filename_base = filename[:-4]
+    else:
+        filename_base = filename
+
+    tree = ElementTree.parse(filename)
+    root = tree.getroot()
+    if root.tag != "osm" or root.attrib.get("version") != "0.6":
+        sys.stderr.write("File %s is not a v0.6 osm file!\n" % (filename,))
+        return False
+
+    output_attr = {"version": "0.3", "generator": root.attrib.get("generator")}
+    output_root = ElementTree.Element("osmChange", output_attr)
+    output_tree = ElementTree.ElementTree(output_root)
+
+    operation = {}
+    for opname in ["create", "modify", "delete"]:
+        operation[opname] = ElementTree.SubElement(output_root,
+                                                   opname, output_attr)
+
+    for element in root:
+        if "id" in element.attrib and int(element.attrib["id"]) < 0:
+            opname = "create"
+        elif "action" in element.attrib:
+            opname = element.attrib.pop("action")
+        else:
+            continue
+        operation[opname].append(element)
+
+    # Does this account for all cases?  Also, is it needed?
+    # (cases like relations containing relations... is that allowed?)
+    # osmsort(operation["create"], ["node", "way", "relation"])
+    # osmsort(operation["delete"], ["relation", "way", "node"])
+
+    output_tree.write(filename_base + ".osc", "utf-8")
+    return True
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] in ("-h", "--help"):
+        sys.stderr.write("Synopsis:\n")
+        sys.stderr.write("    {} <file-name.osm> [<file-name.osm>...]\n"
+                         .format(argv[0],))
+        return 1
+
+    for filename in argv[1:]:
+        if not os.path.exists(filename):
+            sys.stderr.write("File %r doesn't exist!\n" % (filename,))
+            return 1
+        if not convert(filename):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main(sys.argv))
+    except Exception as err:
+        import traceback
+        sys.stderr.write(repr(err) + "\n")
+        traceback.print_exc(file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" osmChange between two releases of the Mali Schools CSV
+
+    Both registries are sorted on CODE_ETABLISSEMENT (spilling to disk
+    past --buffer schools) and merge-joined, so each school is classified
+    as added, removed, moved or retagged in one streaming pass.
+
+    Existing nodes are found in a state file mapping CODE_ETABLISSEMENT
+    to the node id and version on OSM. csv2osm.py and `diff` write a
+    `.codes` file next to each OSM file they produce; once that file has
+    been uploaded, `apply-results` reads its `.diff.xml` to record the new
+    ids and versions in the state:
+
+        csv2osm.py apply-results --state schools.state changesets/*.osc
+        csv2osm.py diff OLD.csv NEW.csv --state schools.state -o sync.osc
+        upload.py ... sync.osc
+        csv2osm.py apply-results --state schools.state sync.osc
+
+    Every coded row is joined, located or not: a school still in the new
+    release without coordinates is counted as unlocated and its node left
+    alone, only codes gone from the new release are deleted. Removed or
+    changed schools missing from the state are counted as unresolved and
+    left out of the osmChange. """
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import sys
+import os
+import shutil
+import argparse
+import tempfile
+import itertools
+import xml.etree.cElementTree as ElementTree
+
+import unicodecsv as csv
+
+from csv2osm import (getNode, getNodeTags, getTags, readSchools,
+                     externalSort, CodesWriter, readCodes)
+
+change_node_tmpl = '<node id="{id}" version="{version}" ' \
+                   'lat="{lat}" lon="{lon}">\n' \
+                   '{tags}\n' \
+                   '</node>'
+
+delete_node_tmpl = '<node id="{id}" version="{version}" ' \
+                   'lat="{lat}" lon="{lon}"/>'
+
+# OSM stores coordinates with 7 decimals
+COORD_EPSILON = 1e-7
+
+classes = ['added', 'removed', 'moved', 'retagged', 'unchanged',
+           'unlocated', 'uncoded', 'duplicate', 'unresolved']
+
+
+def readState(filename):
+    """ {code: (osm id, version)}, empty if the state doesn't exist yet """
+    state = {}
+    if not os.path.exists(filename):
+        return state
+    with open(filename, 'rb') as state_file:
+        csv_reader = csv.reader(state_file, encoding='utf-8')
+        next(csv_reader)
+        for code, osm_id, version in csv_reader:
+            state[code] = (int(osm_id), int(version))
+    return state
+
+
+def writeState(filename, state):
+    # written aside then renamed so an interrupted run keeps the old state
+    with open(filename + '.tmp', 'wb') as state_file:
+        csv_writer = csv.writer(state_file, encoding='utf-8')
+        csv_writer.writerow(['CODE_ETABLISSEMENT', 'id', 'version'])
+        for code in sorted(state.keys()):
+            csv_writer.writerow([code] + list(state[code]))
+    os.rename(filename + '.tmp', filename)
+
+
+def applyResults(state, filename):
+    """ records the upload results of an OSM file into state
+
+        Returns the number of elements applied and of those whose id is
+        not in the `.codes` file. Partial results only update what was
+        actually uploaded. """
+    codes = readCodes(filename)
+    base = filename
+    for extension in ('.osm', '.osc'):
+        if base.endswith(extension):
+            base = base[:-len(extension)]
+    applied = unknown = 0
+    for event, element in ElementTree.iterparse(base + '.diff.xml'):
+        if element.get('old_id') is not None:
+            code = codes.get(int(element.get('old_id')))
+            if code is None:
+                unknown += 1
+            elif element.get('new_id'):
+                state[code] = (int(element.get('new_id')),
+                               int(element.get('new_version')))
+                applied += 1
+            else:
+                # deleted
+                state.pop(code, None)
+                applied += 1
+        element.clear()
+    return applied, unknown
+
+
+def sortedByCode(filename, buffer_size):
+    # located rows first, so they win over unlocated duplicates
+    return externalSort(readSchools(filename, unlocated=True),
+                        key=lambda school: (school.code, school.lat is None,
+                                            school.lnum),
+                        buffer_size=buffer_size)
+
+
+def joinRegistries(old_schools, new_schools):
+    """ yields (old, new) pairs from two code-sorted streams
+
+        Either side is None when the code exists in one release only;
+        duplicated codes are paired in file order. """
+    def groups(schools):
+        for code, group in itertools.groupby(
+                schools, key=lambda school: school.code):
+            yield code, list(group)
+
+    old_groups = groups(old_schools)
+    new_groups = groups(new_schools)
+    old = next(old_groups, None)
+    new = next(new_groups, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            for school in old[1]:
+                yield school, None
+            old = next(old_groups, None)
+        elif old is None or new[0] < old[0]:
+            for school in new[1]:
+                yield None, school
+            new = next(new_groups, None)
+        else:
+            old_group, new_group = old[1], new[1]
+            for index in range(max(len(old_group), len(new_group))):
+                yield (old_group[index] if index < len(old_group) else None,
+                       new_group[index] if index < len(new_group) else None)
+            old = next(old_groups, None)
+            new = next(new_groups, None)
+
+
+def classify(old, new):
+    if new is None:
+        return 'removed'
+    if new.lat is None:
+        return 'unlocated'
+    # a school without coordinates had no node of its own
+    if old is None or old.lat is None:
+        return 'added'
+    if abs(old.lat - new.lat) > COORD_EPSILON or \
+            abs(old.lon - new.lon) > COORD_EPSILON:
+        return 'moved'
+    if getNodeTags(old) != getNodeTags(new):
+        return 'retagged'
+    return 'unchanged'
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog='csv2osm.py diff',
+        description="osmChange turning the old registry into the new one")
+    parser.add_argument('old', help="previous CSV release")
+    parser.add_argument('new', help="new CSV release")
+    parser.add_argument('-o', '--output', metavar='PATH', required=True,
+                        help="osmChange file to write")
+    parser.add_argument('--state', metavar='PATH', required=True,
+                        help="CODE_ETABLISSEMENT to OSM id and version, "
+                             "kept up to date by apply-results")
+    parser.add_argument('--buffer', type=int, default=200000,
+                        help="schools sorted in memory before spilling "
+                             "to disk (default: 200000)")
+    args = parser.parse_args(argv)
+
+    state = readState(args.state)
+    counts = dict((name, 0) for name in classes)
+
+    # elements of each section are spooled until the join completes
+    sections = dict((opname, tempfile.TemporaryFile())
+                    for opname in ['create', 'modify', 'delete'])
+    codes = CodesWriter(args.output)
+
+    def write(opname, node, element_id, code):
+        sections[opname].write(node.encode('utf-8'))
+        sections[opname].write(b'\n')
+        codes.write(element_id, code)
+
+    def write_modify(school, osm_id, version):
+        write('modify', change_node_tmpl.format(
+            id=osm_id, version=version,
+            lat=repr(school.lat), lon=repr(school.lon),
+            tags=getTags(**getNodeTags(school))), osm_id, school.code)
+
+    previous_code = None
+    pairs = joinRegistries(sortedByCode(args.old, args.buffer),
+                           sortedByCode(args.new, args.buffer))
+    for old, new in pairs:
+        code = (old or new).code
+        if not code:
+            counts['uncoded'] += 1
+            continue
+        # the state holds one node per code
+        if code == previous_code:
+            counts['duplicate'] += 1
+            continue
+        previous_code = code
+
+        change = classify(old, new)
+        if change in ('unchanged', 'unlocated'):
+            counts[change] += 1
+            continue
+        if change == 'added':
+            counts[change] += 1
+            if code in state:
+                # back in the registry while its node is still on OSM
+                write_modify(new, *state[code])
+            else:
+                write('create', getNode(new), new.id, code)
+            continue
+
+        # the API wants coordinates on deleted nodes too
+        if code not in state or (change == 'removed' and old.lat is None):
+            counts['unresolved'] += 1
+            continue
+        counts[change] += 1
+        osm_id, version = state[code]
+        if change == 'removed':
+            write('delete', delete_node_tmpl.format(
+                id=osm_id, version=version,
+                lat=repr(old.lat), lon=repr(old.lon)), osm_id, code)
+        else:
+            write_modify(new, osm_id, version)
+
+    codes.close()
+    with open(args.output, 'wb') as output_file:
+        output_file.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                          b'<osmChange version="0.6" '
+                          b'generator="csv2osm.py">\n')
+        for opname in ['create', 'modify', 'delete']:
+            output_file.write('<{}>\n'.format(opname).encode('utf-8'))
+            sections[opname].seek(0)
+            shutil.copyfileobj(sections[opname], output_file)
+            sections[opname].close()
+            output_file.write('</{}>\n'.format(opname).encode('utf-8'))
+        output_file.write(b'</osmChange>\n')
+
+    for name in classes:
+        print("{:>11}: {}".format(name, counts[name]))
+
+
+def applyMain(argv):
+    parser = argparse.ArgumentParser(
+        prog='csv2osm.py apply-results',
+        description="Record upload results of OSM files in the state")
+    parser.add_argument('--state', metavar='PATH', required=True,
+                        help="state file to create or update")
+    parser.add_argument('filenames', metavar='FILE', nargs='+',
+                        help="uploaded .osm/.osc files, with their "
+                             ".codes and .diff.xml next to them")
+    args = parser.parse_args(argv)
+
+    state = readState(args.state)
+    for filename in args.filenames:
+        applied, unknown = applyResults(state, filename)
+        print("{}: {} applied, {} unknown ids".format(
+            filename, applied, unknown))
+    writeState(args.state, state)
+    print("{} schools in {}".format(len(state), args.state))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
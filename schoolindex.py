@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" Queryable in-memory index of the Mali Schools CSV
+
+    Builds once a KD-tree on the X/Y coordinates and inverted indexes on
+    the administrative and status columns, then answers bbox, k-nearest
+    and attribute queries without scanning every school.
+
+    >>> index = SchoolIndex.fromCSV('MLI_schools.csv', 'schools.idx')
+    >>> index.query(Cercle='KIDAL', EAU_POTABLE='no_water_point')
+    >>> index.nearest(-8.0, 12.65, k=3)
+    >>> index.bbox(-8.1, 12.5, -7.9, 12.7, STATUT='Public') """
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import sys
+import os
+import heapq
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from csv2osm import clean, readSchools
+
+# bumped whenever the pickled layout changes
+INDEX_VERSION = 3
+
+
+class SchoolIndex(object):
+
+    # CSV column queried by -> School attribute holding it
+    indexed_fields = {
+        'AE': 'academy',
+        'CAP': 'cap',
+        'Cercle': 'cercle',
+        'Commune': 'commune',
+        'STATUT': 'status',
+        'EAU_POTABLE': 'water',
+    }
+
+    def __init__(self, schools):
+        """ schools: iterable of School, as yielded by readSchools() """
+        self.schools = []
+        self.points = []
+        self.inverted = dict((field, {}) for field in self.indexed_fields)
+
+        for school in schools:
+            position = len(self.schools)
+            self.schools.append(school)
+            self.points.append((school.lon, school.lat))
+            for field, attribute in self.indexed_fields.items():
+                # keys are cleaned like query values; School keeps raw ones
+                value = getattr(school, attribute)
+                value = clean(value) if value else value
+                self.inverted[field].setdefault(value, []).append(position)
+
+        # implicit balanced KD-tree: the median of tree[lo:hi] sits at
+        # (lo + hi) // 2, split on X at even depths and on Y at odd ones.
+        self.tree = list(range(len(self.points)))
+        self._build(0, len(self.tree), 0)
+
+    def _build(self, lo, hi, axis):
+        if hi - lo <= 1:
+            return
+        points = self.points
+        self.tree[lo:hi] = sorted(self.tree[lo:hi],
+                                  key=lambda pos: points[pos][axis])
+        mid = (lo + hi) // 2
+        self._build(lo, mid, 1 - axis)
+        self._build(mid + 1, hi, 1 - axis)
+
+    def __len__(self):
+        return len(self.schools)
+
+    def _matching(self, attrs):
+        """ set of positions matching every field=value, None if no attrs """
+        if not attrs:
+            return None
+        postings = []
+        for field, value in attrs.items():
+            if field not in self.inverted:
+                raise KeyError("{} is not an indexed field".format(field))
+            value = clean(value) if value else value
+            postings.append(self.inverted[field].get(value, []))
+        postings.sort(key=len)
+        matching = set(postings[0])
+        for posting in postings[1:]:
+            matching.intersection_update(posting)
+            if not matching:
+                break
+        return matching
+
+    def values(self, field):
+        """ distinct values of an indexed field with their school count """
+        return dict((value, len(posting))
+                    for value, posting in self.inverted[field].items())
+
+    def query(self, **attrs):
+        """ schools matching every indexed field=value given """
+        matching = self._matching(attrs)
+        if matching is None:
+            return list(self.schools)
+        return [self.schools[pos] for pos in sorted(matching)]
+
+    def bbox(self, minx, miny, maxx, maxy, **attrs):
+        """ schools within the lon/lat box, optionally filtered """
+        matching = self._matching(attrs)
+        points = self.points
+
+        # a short posting list is cheaper to filter than walking the tree
+        if matching is not None and len(matching) < 64:
+            found = [pos for pos in matching
+                     if minx <= points[pos][0] <= maxx and
+                     miny <= points[pos][1] <= maxy]
+            return [self.schools[pos] for pos in sorted(found)]
+
+        lower = (minx, miny)
+        upper = (maxx, maxy)
+        found = []
+        stack = [(0, len(self.tree), 0)]
+        while stack:
+            lo, hi, axis = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            pos = self.tree[mid]
+            x, y = points[pos]
+            if minx <= x <= maxx and miny <= y <= maxy and \
+                    (matching is None or pos in matching):
+                found.append(pos)
+            if lower[axis] <= points[pos][axis]:
+                stack.append((lo, mid, 1 - axis))
+            if upper[axis] >= points[pos][axis]:
+                stack.append((mid + 1, hi, 1 - axis))
+        return [self.schools[pos] for pos in sorted(found)]
+
+    def nearest(self, x, y, k=1, **attrs):
+        """ k schools closest to x/y, optionally filtered, nearest first
+
+            Distances are planar in degrees, which ranks correctly at
+            Mali's latitudes for neighbourhood-sized searches. """
+        if k < 1:
+            raise ValueError("k must be at least 1")
+        matching = self._matching(attrs)
+        points = self.points
+
+        # no branch can be pruned before k matches are found, so a short
+        # posting list is cheaper to rank than walking the tree
+        if matching is not None and len(matching) < 64:
+            ranked = heapq.nsmallest(
+                k, (((points[pos][0] - x) ** 2 + (points[pos][1] - y) ** 2,
+                     -pos) for pos in matching))
+            return [self.schools[-pos] for dist, pos in ranked]
+
+        target = (x, y)
+        best = []  # max-heap of (-distance², position)
+
+        def visit(lo, hi, axis):
+            if lo >= hi:
+                return
+            mid = (lo + hi) // 2
+            pos = self.tree[mid]
+            px, py = points[pos]
+            if matching is None or pos in matching:
+                dist = (px - x) ** 2 + (py - y) ** 2
+                if len(best) < k:
+                    heapq.heappush(best, (-dist, pos))
+                elif dist < -best[0][0]:
+                    heapq.heapreplace(best, (-dist, pos))
+            delta = target[axis] - points[pos][axis]
+            if delta < 0:
+                near, far = (lo, mid), (mid + 1, hi)
+            else:
+                near, far = (mid + 1, hi), (lo, mid)
+            visit(near[0], near[1], 1 - axis)
+            if len(best) < k or delta ** 2 < -best[0][0]:
+                visit(far[0], far[1], 1 - axis)
+
+        visit(0, len(self.tree), 0)
+        return [self.schools[pos] for dist, pos in sorted(best, reverse=True)]
+
+    def save(self, path):
+        with open(path, 'wb') as index_file:
+            pickle.dump((INDEX_VERSION, self.__dict__), index_file,
+                        pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as index_file:
+            version, state = pickle.load(index_file)
+        if version != INDEX_VERSION:
+            raise ValueError("{} was built by another version "
+                             "of schoolindex".format(path))
+        index = cls.__new__(cls)
+        index.__dict__.update(state)
+        return index
+
+    @classmethod
+    def fromCSV(cls, filename, cache=None):
+        """ loads `cache` if fresher than the CSV, else builds and saves it """
+        if cache and os.path.exists(cache) and \
+                os.path.getmtime(cache) >= os.path.getmtime(filename):
+            try:
+                return cls.load(cache)
+            except ValueError:
+                pass
+        index = cls(readSchools(filename))
+        if cache:
+            index.save(cache)
+        return index
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Usage: {} MLI_schools.csv index-file".format(sys.argv[0]))
+        sys.exit(1)
+    index = SchoolIndex.fromCSV(sys.argv[1], sys.argv[2])
+    print("{} schools indexed in {}".format(len(index), sys.argv[2]))
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+""" Aggregated statistics per academy, CAP or commune
+
+    All schools of the registry are counted, located or not. Rows are read
+    as undecoded bytes and folded into one list of counters per raw group
+    key in a single pass; keys are decoded and cleaned once per group. """
+
+from __future__ import (unicode_literals, absolute_import,
+                        division, print_function)
+import sys
+import csv as bytes_csv
+import json
+import argparse
+
+import unicodecsv as csv
+
+from csv2osm import (clean, headers, toInt, water_options,
+                     drinkable_water_points)
+
+group_fields = ['AE', 'CAP', 'Cercle', 'Commune']
+
+water_points = ['tap', 'working_drilling', 'inexhaustible_well',
+                'exhaustible_well', 'no_water_point', 'unknown']
+
+# positions in a group's counter list
+(SCHOOLS, PUPILS, BOYS, GIRLS, TEACHERS, TAUGHT_PUPILS,
+ LATRINES, WITH_LATRINES) = range(8)
+WATER = 8
+NB_COUNTERS = WATER + len(water_points)
+
+counter_names = ['schools', 'pupils', 'boys', 'girls', 'teachers',
+                 'taught_pupils', 'latrines', 'schools_with_latrines'] + \
+    ['water:{}'.format(water_point) for water_point in water_points]
+
+ratio_names = ['pupil_teacher_ratio', 'pupils_per_latrine',
+               'latrine_coverage', 'drinking_water_coverage']
+
+
+def computeStats(filename, group_by):
+    """ {cleaned group key tuple: counter list} for the given columns """
+    key_cols = [headers.index(field) for field in group_by]
+    total_col = headers.index('TOTAL')
+    boys_col = headers.index('GARCONS')
+    girls_col = headers.index('FILLES')
+    teachers_col = headers.index('NBRE ENSEIGNANTS')
+    latrines_col = headers.index('NOMBRE_LATRINES')
+    water_col = headers.index('EAU_POTABLE')
+    water_slots = dict(
+        (raw.encode('utf-8'), WATER + water_points.index(water_point))
+        for raw, water_point in water_options.items())
+    unknown_slot = WATER + water_points.index('unknown')
+
+    groups = {}
+    with open(filename, 'rb') as input_csv_file:
+        csv_reader = bytes_csv.reader(input_csv_file)
+        next(csv_reader)
+        for row in csv_reader:
+            if not row:
+                continue
+
+            key = tuple([row[col] for col in key_cols])
+            counters = groups.get(key)
+            if counters is None:
+                counters = groups[key] = [0] * NB_COUNTERS
+
+            pupils = toInt(row[total_col])
+            counters[SCHOOLS] += 1
+            counters[PUPILS] += pupils
+            counters[BOYS] += toInt(row[boys_col])
+            counters[GIRLS] += toInt(row[girls_col])
+            if row[teachers_col]:
+                counters[TEACHERS] += int(row[teachers_col])
+                counters[TAUGHT_PUPILS] += pupils
+            if row[latrines_col]:
+                nb_latrines = int(row[latrines_col])
+                counters[LATRINES] += nb_latrines
+                if nb_latrines:
+                    counters[WITH_LATRINES] += 1
+            counters[water_slots.get(row[water_col], unknown_slot)] += 1
+
+    # raw keys differing only by stray spaces fold into the same group
+    cleaned = {}
+    for key, counters in groups.items():
+        key = tuple([clean(value.decode('utf-8')) for value in key])
+        if key in cleaned:
+            cleaned[key] = [a + b for a, b in zip(cleaned[key], counters)]
+        else:
+            cleaned[key] = counters
+    return cleaned
+
+
+def getRatios(counters):
+    def ratio(num, den):
+        return round(num / den, 2) if den else None
+
+    drinkable = sum(counters[WATER + water_points.index(water_point)]
+                    for water_point in drinkable_water_points)
+    return [ratio(counters[TAUGHT_PUPILS], counters[TEACHERS]),
+            ratio(counters[PUPILS], counters[LATRINES]),
+            ratio(counters[WITH_LATRINES], counters[SCHOOLS]),
+            ratio(drinkable, counters[SCHOOLS])]
+
+
+def getColumns(group_by):
+    return list(group_by) + counter_names + ratio_names
+
+
+def getRows(stats):
+    for key in sorted(stats.keys()):
+        counters = stats[key]
+        yield list(key) + counters + getRatios(counters)
+
+
+def writeCSV(stats, group_by, output_file):
+    csv_writer = csv.writer(output_file, encoding='utf-8')
+    csv_writer.writerow(getColumns(group_by))
+    for row in getRows(stats):
+        csv_writer.writerow(row)
+
+
+def writeJSON(stats, group_by, output_file):
+    columns = getColumns(group_by)
+    records = [dict(zip(columns, row)) for row in getRows(stats)]
+    output = json.dumps(records, ensure_ascii=False, indent=1,
+                        sort_keys=True)
+    output_file.write(output.encode('utf-8'))
+    output_file.write(b'\n')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog='csv2osm.py stats',
+        description="Totals and ratios per academy, CAP or commune")
+    parser.add_argument('filename', help="MLI_schools.csv path")
+    parser.add_argument('--by', default='AE',
+                        help="comma-separated columns among {} "
+                             "(default: AE)".format(', '.join(group_fields)))
+    parser.add_argument('--format', choices=['csv', 'json'], default=None,
+                        help="defaults to the output extension, else csv")
+    parser.add_argument('-o', '--output', metavar='PATH',
+                        help="defaults to stdout")
+    args = parser.parse_args(argv)
+
+    group_by = args.by.split(',')
+    for field in group_by:
+        if field not in group_fields:
+            parser.error("can't group by {}".format(field))
+
+    output_format = args.format
+    if output_format is None:
+        output_format = 'json' if args.output and \
+            args.output.endswith('.json') else 'csv'
+    writer = writeJSON if output_format == 'json' else writeCSV
+
+    stats = computeStats(args.filename, group_by)
+    if args.output:
+        with open(args.output, 'wb') as output_file:
+            writer(stats, group_by, output_file)
+    else:
+        writer(stats, group_by, getattr(sys.stdout, 'buffer', sys.stdout))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
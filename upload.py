@@ -0,0 +1,612 @@
+#! /usr/bin/env python3
+# vim: fileencoding=utf-8 encoding=utf-8 et sw=4
+
+# Copyright (C) 2009 Jacek Konieczny <jajcus@jajcus.net>
+# Copyright (C) 2009 Andrzej Zaborowski <balrogg@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""
+Uploads complete osmChange 0.3 files.  Use your login (not email) as username.
+
+Python 3 port of upload-python2.py.  HTTP and XML modules are only
+imported once there is something to upload, and the version comes from
+__version__ instead of running svnversion.
+
+Changes are sent in several upload calls whose size follows the observed
+server latency (see UploadScheduler).  Calls the server rejected without
+applying them (429, 503) are retried with jittered exponential backoff,
+as are idempotent steps such as closing the changeset.  When a call times
+out or fails with 500, 502 or 504 the server may still be applying it:
+the changeset is downloaded until it holds the batch or stops changing
+(see OSM_API.settled), and the batch is only sent again in the latter
+case.  Batches must not reference placeholder ids created by another
+batch, which holds for the school nodes this tool uploads.
+
+Rerunning on a file whose .diff.xml exists resumes the upload: elements
+already listed there are skipped and the new results are appended.
+"""
+
+__version__ = "$Revision: 21 $"
+
+import os
+import sys
+
+version = __version__.split()[1]
+
+synopsis = u"""Synopsis:
+    %s [-u user] [-p password] [-m comment] [-c y] [-s changeset] [-n] [-l]
+        [-t target-seconds] <file-name.osc> [<file-name.osc>...]
+"""
+
+# worth retrying for idempotent requests
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# the server turned the request away without applying it
+REJECTED_STATUSES = (429, 503)
+# the batch may or may not have been applied
+UNKNOWN_STATUSES = (500, 502, 504)
+
+
+class HTTPError(Exception):
+    pass
+
+
+class UploadScheduler(object):
+    """ Picks how many elements go in each upload call
+
+        After each call the size is scaled by target_latency / elapsed
+        (at most halved or doubled at once); every failed call halves
+        it. 10000 is the API limit of elements per changeset. """
+
+    def __init__(self, target_latency=30.0, size=500,
+                 min_size=50, max_size=10000):
+        self.target_latency = target_latency
+        self.size = size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.calls = 0
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def record(self, nb_elements, elapsed):
+        self.calls += 1
+        self.elapsed += elapsed
+        ratio = self.target_latency / max(elapsed, 0.001)
+        ratio = min(2.0, max(0.5, ratio))
+        self.size = int(min(self.max_size,
+                            max(self.min_size, nb_elements * ratio)))
+
+    def failed(self):
+        self.calls += 1
+        self.errors += 1
+        self.size = max(self.min_size, self.size // 2)
+
+    def summary(self):
+        return u"%i calls, %i failed, %.1fs average, next batch %i" % (
+            self.calls, self.errors,
+            self.elapsed / max(self.calls - self.errors, 1), self.size)
+
+
+def pending_elements(change, diff_result=None):
+    """ (operation, element) pairs of change missing from diff_result
+
+        A diffResult only lists applied elements; deletes have no new_id
+        there, so any entry counts. """
+    done = set()
+    if diff_result is not None:
+        done = set((element.tag, element.get("old_id"))
+                   for element in diff_result)
+    elements = []
+    for operation in change:
+        if operation.tag not in ("create", "modify", "delete"):
+            continue
+        for element in operation:
+            if (element.tag, element.get("id")) not in done:
+                elements.append((operation.tag, element))
+    return elements
+
+
+class OSM_API(object):
+
+    url = 'http://master.apis.dev.openstreetmap.org/'
+    timeout = 600
+    max_retries = 6
+    backoff = 2.0
+    max_backoff = 120.0
+    # wait between changeset downloads after an unknown upload outcome
+    settle = 60.0
+
+    def __init__(self, username=None, password=None, url=None):
+        if username and password:
+            self.username = username
+            self.password = password
+        else:
+            self.username = ""
+            self.password = ""
+        self.changeset = None
+        self.diff_result = None
+        self.progress_msg = None
+        if url:
+            self.url = url
+        print(self.url)
+
+    def msg(self, mesg):
+        sys.stderr.write(u"\r%s…                        " % (self.progress_msg))
+        sys.stderr.write(u"\r%s… %s" % (self.progress_msg, mesg))
+        sys.stderr.flush()
+
+    def request(self, conn, method, url, body, headers, progress):
+        if progress:
+            self.msg(u"making request")
+            conn.putrequest(method, url)
+            self.msg(u"sending headers")
+            if body:
+                conn.putheader('Content-Length', str(len(body)))
+            for hdr, value in headers.items():
+                conn.putheader(hdr, value)
+            self.msg(u"end of headers")
+            conn.endheaders()
+            self.msg(u" 0%")
+            if body:
+                start = 0
+                size = len(body)
+                chunk = size // 100
+                if chunk < 16384:
+                    chunk = 16384
+                while start < size:
+                    end = min(size, start + chunk)
+                    conn.send(body[start:end])
+                    start = end
+                    self.msg(u"%2i%%" % (start * 100 // size))
+        else:
+            self.msg(u" ")
+            conn.request(method, url, body, headers)
+
+    def _run_request(self, method, url, body=None, progress=0,
+                     content_type="text/xml"):
+        import base64
+        import http.client
+        import urllib.parse
+
+        url = urllib.parse.urljoin(self.url, url)
+        purl = urllib.parse.urlparse(url)
+        if purl.scheme == "http":
+            connection_class = http.client.HTTPConnection
+        elif purl.scheme == "https":
+            connection_class = http.client.HTTPSConnection
+        else:
+            raise ValueError("Unsupported url scheme: %r" % (purl.scheme,))
+        url = purl.path
+        if purl.query:
+            url += "?" + purl.query
+        headers = {}
+        if body:
+            headers["Content-Type"] = content_type
+
+        if not self.username:
+            raise HTTPError(0, "Need a username")
+
+        creds = (self.username + ":" + self.password).encode("utf-8")
+        headers["Authorization"] = "Basic " + \
+            base64.b64encode(creds).decode("ascii")
+
+        self.msg(u"connecting")
+        conn = connection_class(purl.netloc, timeout=self.timeout)
+        try:
+            self.request(conn, method, url, body, headers, progress)
+            self.msg(u"waiting for status")
+            response = conn.getresponse()
+
+            if response.status == http.client.OK:
+                self.msg(u"reading response")
+                sys.stderr.flush()
+                response_body = response.read().decode("utf-8")
+            else:
+                raise HTTPError(response.status, "%03i: %s (%s)" % (
+                    response.status, response.reason,
+                    response.read().decode("utf-8", "replace")))
+        finally:
+            conn.close()
+        return response_body
+
+    def _backoff(self, attempt, err):
+        """ sleeps before retry number `attempt`, False when out of retries """
+        import random
+        import time
+
+        if attempt >= self.max_retries:
+            return False
+        delay = random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        self.msg(u"%s, retrying in %.1fs" % (err, delay))
+        time.sleep(delay)
+        return True
+
+    def _retry(self, send, statuses, network_errors=False):
+        import http.client
+
+        attempt = 0
+        while True:
+            try:
+                return send()
+            except HTTPError as err:
+                if err.args[0] not in statuses or \
+                        not self._backoff(attempt, err.args[1]):
+                    raise
+            except (OSError, http.client.HTTPException) as err:
+                if not network_errors or not self._backoff(attempt, err):
+                    raise
+            attempt += 1
+
+    def create_changeset(self, created_by, comment):
+        import xml.etree.ElementTree as ElementTree
+
+        if self.changeset is not None:
+            raise RuntimeError("Changeset already opened")
+        self.progress_msg = u"I'm creating the changeset"
+        self.msg(u"")
+        root = ElementTree.Element("osm")
+        element = ElementTree.SubElement(root, "changeset")
+        ElementTree.SubElement(element, "tag", {"k": "created_by", "v": created_by})
+        ElementTree.SubElement(element, "tag", {"k": "comment", "v": comment})
+        ElementTree.SubElement(element, "tag", {"k": "import", "v": "yes"})
+        ElementTree.SubElement(element, "tag", {"k": "source", "v": u"UNICEF"})
+        ElementTree.SubElement(element, "tag", {"k": "source:date", "v": u"2012"})
+        ElementTree.SubElement(element, "tag", {"k": "url", "v": "http://wiki.openstreetmap.org/wiki/Import_MALI_UNICEF_Education"})
+        body = ElementTree.tostring(root, "utf-8")
+        # not idempotent: only retry when nothing was created
+        reply = self._retry(
+            lambda: self._run_request("PUT", "/api/0.6/changeset/create",
+                                      body),
+            REJECTED_STATUSES)
+        changeset = int(reply.strip())
+        self.msg(u"done. Id: %i" % (changeset))
+        print(u"", file=sys.stderr)
+        self.changeset = changeset
+
+    def settled(self, batch):
+        """ diffResult entries for batch, None once sure it was lost
+
+            The changeset is downloaded right away, then every `settle`
+            seconds until it holds the batch or two downloads in a row
+            are the same. It is left to a rerun to resume from the
+            .diff.xml when the changeset never settles. """
+        import time
+
+        self.progress_msg = u"Checking changeset %i" % (self.changeset,)
+        previous = None
+        for attempt in range(self.max_retries):
+            reply = self._retry(
+                lambda: self._run_request(
+                    "GET", "/api/0.6/changeset/%i/download"
+                    % (self.changeset,)),
+                RETRY_STATUSES, network_errors=True)
+            results = self.applied(batch, reply)
+            if results is not None:
+                return results
+            if reply == previous:
+                return None
+            previous = reply
+            self.msg(u"batch not there yet, checking again in %.0fs"
+                     % (self.settle,))
+            time.sleep(self.settle)
+        raise HTTPError(0, "Changeset %i is still changing, run again "
+                        "later to resume" % (self.changeset,))
+
+    def applied(self, batch, reply):
+        """ diffResult entries for batch if the changeset holds it, else None
+
+            reply is the changeset download. Uploads are applied whole, so
+            the batch is there when the changeset has elements missing
+            from self.diff_result. Created ids are allocated in upload
+            order: they are matched to the placeholders by rank, and
+            checked against their tags. """
+        import xml.etree.ElementTree as ElementTree
+
+        known = set((element.tag,
+                     element.get("new_id") or element.get("old_id"))
+                    for element in self.diff_result)
+        found = {}
+        for operation in ElementTree.fromstring(reply):
+            for element in operation:
+                if (element.tag, element.get("id")) not in known:
+                    found.setdefault((operation.tag, element.tag),
+                                     []).append(element)
+        if not found:
+            return None
+
+        def tags(element):
+            return dict((tag.get("k"), tag.get("v"))
+                        for tag in element.findall("tag"))
+
+        for elements in found.values():
+            elements.sort(key=lambda element: int(element.get("id")))
+        results = []
+        for opname, element in batch:
+            if opname == "create":
+                candidates = found.get((opname, element.tag), [])
+                match = candidates.pop(0) if candidates else None
+                if match is not None and tags(match) != tags(element):
+                    match = None
+            else:
+                match = None
+                for candidate in found.get((opname, element.tag), []):
+                    if candidate.get("id") == element.get("id"):
+                        match = candidate
+                        found[(opname, element.tag)].remove(candidate)
+                        break
+            if match is None:
+                raise HTTPError(0, "Changeset %i holds changes that don't "
+                                "match the batch sent, check it before "
+                                "uploading again" % (self.changeset,))
+            attrib = {"old_id": element.get("id")}
+            if opname != "delete":
+                attrib["new_id"] = match.get("id")
+                attrib["new_version"] = match.get("version")
+            results.append(ElementTree.Element(element.tag, attrib))
+        return results
+
+    def upload(self, change, scheduler, diff_result=None):
+        """ sends change in calls sized by scheduler
+
+            Results accumulate in self.diff_result, so they are kept for
+            the batches already applied when a later one fails. Elements
+            listed in diff_result, from an earlier run, are skipped and
+            their results kept. """
+        import time
+        import http.client
+        import xml.etree.ElementTree as ElementTree
+
+        if self.changeset is None:
+            raise RuntimeError("Changeset not opened")
+        self.progress_msg = u"Now I'm sending changes"
+        self.msg(u"")
+        elements = pending_elements(change, diff_result)
+        for opname, element in elements:
+            element.attrib["changeset"] = str(self.changeset)
+        if diff_result is None:
+            diff_result = ElementTree.Element(
+                "diffResult", {"version": "0.6", "generator": "upload.py"})
+        self.diff_result = diff_result
+        url = "/api/0.6/changeset/%i/upload" % (self.changeset,)
+
+        done = 0
+        attempt = 0
+        while done < len(elements):
+            batch = elements[done:done + scheduler.size]
+            self.progress_msg = u"Sending %i-%i of %i elements" % (
+                done + 1, done + len(batch), len(elements))
+            root = ElementTree.Element(change.tag, change.attrib)
+            section = None
+            for opname, element in batch:
+                if section is None or section.tag != opname:
+                    section = ElementTree.SubElement(root, opname)
+                section.append(element)
+            body = ElementTree.tostring(root, "utf-8")
+
+            started = time.time()
+            try:
+                reply = self._run_request("POST", url, body, 1)
+            except (HTTPError, OSError, http.client.HTTPException) as err:
+                # retried with a smaller batch unless the server applied it
+                scheduler.failed()
+                if isinstance(err, HTTPError):
+                    status, message = err.args
+                    if status not in RETRY_STATUSES:
+                        raise
+                else:
+                    status, message = None, err
+                if status not in REJECTED_STATUSES:
+                    results = self.settled(batch)
+                    if results is not None:
+                        self.diff_result.extend(results)
+                        done += len(batch)
+                        attempt = 0
+                        continue
+                    # settled() already waited for the server
+                    if attempt >= self.max_retries:
+                        raise
+                elif not self._backoff(attempt, message):
+                    raise
+                attempt += 1
+                continue
+            scheduler.record(len(batch), time.time() - started)
+            attempt = 0
+            self.diff_result.extend(ElementTree.fromstring(reply))
+            done += len(batch)
+
+        self.progress_msg = u"Sent %i elements" % (len(elements),)
+        self.msg(scheduler.summary())
+        print(u"", file=sys.stderr)
+        return self.diff_xml()
+
+    def diff_xml(self):
+        import xml.etree.ElementTree as ElementTree
+
+        return ElementTree.tostring(self.diff_result, "unicode")
+
+    def close_changeset(self):
+        if self.changeset is None:
+            raise RuntimeError("Changeset not opened")
+        self.progress_msg = u"Closing"
+        self.msg(u"")
+        try:
+            self._retry(
+                lambda: self._run_request("PUT", "/api/0.6/changeset/%i/close"
+                                          % (self.changeset,)),
+                RETRY_STATUSES, network_errors=True)
+        except HTTPError as err:
+            # the reply to an earlier attempt may have been lost
+            if err.args[0] != 409:
+                raise
+            self.msg(u"already closed")
+        self.changeset = None
+        self.msg(u"done, too.")
+        print(u"", file=sys.stderr)
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] in ("-h", "--help"):
+        sys.stderr.write(synopsis % (argv[0],))
+        return 1
+
+    filenames = []
+    param = {}
+    num = 0
+    skip = 0
+    for arg in argv[1:]:
+        num += 1
+        if skip:
+            skip -= 1
+            continue
+
+        if arg == "-u":
+            param['user'] = argv[num + 1]
+            skip = 1
+        elif arg == "-p":
+            param['pass'] = argv[num + 1]
+            skip = 1
+        elif arg == "-c":
+            param['confirm'] = argv[num + 1]
+            skip = 1
+        elif arg == "-m":
+            param['comment'] = argv[num + 1]
+            skip = 1
+        elif arg == "-s":
+            param['changeset'] = argv[num + 1]
+            skip = 1
+        elif arg == "-n":
+            param['start'] = 1
+        elif arg == "-l":
+            param['live'] = True
+        elif arg == "-t":
+            param['target'] = float(argv[num + 1])
+            skip = 1
+        else:
+            filenames.append(arg)
+
+    if 'user' in param:
+        login = param['user']
+    else:
+        login = input("OSM login: ")
+    if not login:
+        return 1
+    if 'pass' in param:
+        password = param['pass']
+    else:
+        password = input("OSM password: ")
+    if not password:
+        return 1
+    url = 'https://api.openstreetmap.org/' if 'live' in param else None
+
+    api = OSM_API(login, password, url)
+    scheduler = UploadScheduler(param.get('target', 30.0))
+
+    for filename in filenames:
+        if not os.path.exists(filename):
+            print(u"File %r doesn't exist!" % (filename,), file=sys.stderr)
+            return 1
+
+        if filename.endswith(".osc"):
+            diff_fn = filename[:-4] + ".diff.xml"
+        else:
+            diff_fn = filename + ".diff.xml"
+
+        import xml.etree.ElementTree as ElementTree
+        tree = ElementTree.parse(filename)
+        root = tree.getroot()
+        if root.tag != "osmChange" or (root.attrib.get("version") != "0.3" and
+                                       root.attrib.get("version") != "0.6"):
+            print(u"File %s is not a v0.3 osmChange file!" % (filename,),
+                  file=sys.stderr)
+            return 1
+
+        diff_result = None
+        if os.path.exists(diff_fn):
+            diff_result = ElementTree.parse(diff_fn).getroot()
+            if not pending_elements(root, diff_result):
+                print(u"All of %r is in %r already, skipping"
+                      % (filename, diff_fn), file=sys.stderr)
+                continue
+            print(u"Resuming: %i elements are in %r already"
+                  % (len(diff_result), diff_fn), file=sys.stderr)
+
+        if filename.endswith(".osc"):
+            comment_fn = filename[:-4] + ".comment"
+        else:
+            comment_fn = filename + ".comment"
+        try:
+            with open(comment_fn, "r", encoding="utf-8") as comment_file:
+                comment = comment_file.read().strip()
+        except IOError:
+            comment = None
+        if not comment:
+            if 'comment' in param:
+                comment = param['comment']
+            else:
+                comment = input("Your comment to %r: " % (filename,))
+            if not comment:
+                return 1
+
+        print(u"     File: %r" % (filename,), file=sys.stderr)
+        print(u"  Comment: %s" % (comment,), file=sys.stderr)
+
+        if 'confirm' in param:
+            sure = param['confirm']
+        else:
+            print(u"Are you sure you want to send these changes?",
+                  end=u" ", file=sys.stderr)
+            sure = input()
+        if sure.lower() not in ("y", "yes"):
+            print(u"Skipping...\n", file=sys.stderr)
+            continue
+        print(u"", file=sys.stderr)
+        if 'changeset' in param:
+            api.changeset = int(param['changeset'])
+        else:
+            api.create_changeset(u"upload.py v. %s" % (version,), comment)
+            if 'start' in param:
+                print(api.changeset)
+                return 0
+        try:
+            api.upload(root, scheduler, diff_result)
+        except HTTPError as err:
+            code, message = err.args
+            sys.stderr.write("\n" + message + "\n")
+            if len(api.diff_result):
+                sys.stderr.write(u"Only %i elements were uploaded, their "
+                                 "ids are in %s, run again to resume\n"
+                                 % (len(api.diff_result), diff_fn))
+            return 1
+        finally:
+            if api.diff_result is not None and len(api.diff_result):
+                with open(diff_fn, "w", encoding="utf-8") as diff_file:
+                    diff_file.write(api.diff_xml())
+            if 'changeset' not in param:
+                api.close_changeset()
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main(sys.argv))
+    except HTTPError as err:
+        sys.stderr.write(err.args[1])
+        sys.exit(1)
+    except Exception as err:
+        import traceback
+        print(repr(err), file=sys.stderr)
+        traceback.print_exc(file=sys.stderr)
+        sys.exit(1)